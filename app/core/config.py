@@ -1,5 +1,6 @@
+import os
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Union
 
 from pydantic import AnyHttpUrl, BaseSettings, validator
 
@@ -9,6 +10,19 @@ class Settings(BaseSettings):
     BACKEND_CORS_ORIGINS: List[AnyHttpUrl] = []
 
     DUCKDB_PATH: Path = Path("duck.db")
+    # number of threads used by DuckDB, defaults to number of CPUs
+    DUCKDB_THREADS: int = os.cpu_count() or 4
+    # e.g. `4GB`, DuckDB uses 80% of RAM by default
+    DUCKDB_MEMORY_LIMIT: Optional[str] = None
+    # maximum number of cursors shared by concurrent requests
+    DUCKDB_POOL_SIZE: int = 32
+    # seconds to wait for a free cursor before responding with 503
+    DUCKDB_POOL_TIMEOUT: float = 30
+
+    # maximum size of in-memory cache of serialized variable data in bytes
+    DATA_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    # directory for feather files of whole ETL tables, files are not cached if not set
+    FEATHER_CACHE_DIR: Optional[Path] = None
 
     @validator("BACKEND_CORS_ORIGINS", pre=True)
     def assemble_cors_origins(cls, v: Union[str, List[str]]) -> Union[List[str], str]:
@@ -18,6 +32,11 @@ class Settings(BaseSettings):
             return v
         raise ValueError(v)
 
+    @property
+    def cors_origins(self) -> List[str]:
+        """CORS origins as plain strings expected by CORSMiddleware."""
+        return [str(origin) for origin in self.BACKEND_CORS_ORIGINS]
+
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -1,4 +1,6 @@
+import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import structlog
 from fastapi import FastAPI
@@ -15,7 +17,7 @@ def get_application():
 
     _app.add_middleware(
         CORSMiddleware,
-        allow_origins=[str(origin) for origin in settings.BACKEND_CORS_ORIGINS],
+        allow_origins=settings.cors_origins,
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
@@ -26,6 +28,17 @@ def get_application():
 
 app = get_application()
 
+
+@app.on_event("startup")
+def limit_threadpool() -> None:
+    # sync endpoints run in the default executor of the event loop, size it by the number
+    # of DuckDB cursors so that requests don't pile up in threads waiting for a cursor
+    # and don't oversubscribe DuckDB which parallelizes queries on its own
+    asyncio.get_event_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.DUCKDB_POOL_SIZE)
+    )
+
+
 # mount subapplications as versions
 app.mount("/v1", v1)
 
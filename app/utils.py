@@ -1,32 +1,283 @@
 import functools
-from typing import Any
+import gzip
+import io
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Any, Callable, Hashable, Iterator, Optional, TypeVar
+from urllib.parse import parse_qs
 
 import duckdb
 import orjson
-import pandas as pd
 import structlog
-from fastapi.responses import JSONResponse
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from app.core.config import settings
 
 log = structlog.get_logger()
 
 
+def _orjson_default(obj: Any) -> Any:
+    # numpy arrays with dtypes orjson doesn't support natively (e.g. object arrays of
+    # strings, masked arrays with nulls) and pandas categoricals end up here
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    # DECIMAL columns are returned as `Decimal` by duckdb
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def orjson_dumps(content: Any) -> bytes:
+    return orjson.dumps(
+        content,
+        default=_orjson_default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+    )
+
+
 class ORJSONResponse(JSONResponse):
     """It serializes dataclass, datetime, numpy, and UUID instances natively."""
 
     media_type = "application/json"
 
     def render(self, content: Any) -> bytes:
-        return orjson.dumps(content)
+        return orjson_dumps(content)
+
+
+class _GZipResponder(GZipResponder):
+    def __init__(self, app: ASGIApp, minimum_size: int, compresslevel: int) -> None:
+        super().__init__(app, minimum_size)
+        # starlette 0.14 always compresses with the slowest level 9, replace the buffer
+        # too because gzip header was already written into it
+        self.gzip_buffer = io.BytesIO()
+        self.gzip_file = gzip.GzipFile(
+            mode="wb", fileobj=self.gzip_buffer, compresslevel=compresslevel
+        )
+
+
+class GZipMiddleware:
+    """Like starlette's `GZipMiddleware`, but with configurable compression level and
+    without compressing feather files which are already compressed with zstd."""
+
+    def __init__(
+        self, app: ASGIApp, minimum_size: int = 500, compresslevel: int = 6
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and not _is_feather_request(scope):
+            headers = Headers(scope=scope)
+            if "gzip" in headers.get("Accept-Encoding", ""):
+                responder = _GZipResponder(
+                    self.app, self.minimum_size, self.compresslevel
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+def _is_feather_request(scope: Scope) -> bool:
+    if scope["path"].endswith((".feather", ".feather_direct")):
+        return True
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return not {"feather", "feather_direct"}.isdisjoint(query.get("type", []))
+
+
+_connection: Optional[duckdb.DuckDBPyConnection] = None
+_connection_lock = threading.Lock()
+
+# duckdb connection is not threadsafe, requests check out their own cursor from a bounded
+# pool and return it when they're done (LIFO keeps recently used cursors warm)
+_pool: "queue.LifoQueue[duckdb.DuckDBPyConnection]" = queue.LifoQueue(
+    maxsize=settings.DUCKDB_POOL_SIZE
+)
+_pool_lock = threading.Lock()
+_pool_created = 0
+
+
+def _duckdb_config() -> dict:
+    config = {
+        "threads": str(settings.DUCKDB_THREADS),
+        # keep metadata of read tables cached between queries
+        "enable_object_cache": "true",
+    }
+    if settings.DUCKDB_MEMORY_LIMIT:
+        config["memory_limit"] = settings.DUCKDB_MEMORY_LIMIT
+    return config
+
+
+def _get_shared_connection() -> duckdb.DuckDBPyConnection:
+    # open database only once per process, cursors then share its catalog and cache
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            log.info("duckdb.new_connection")
+            _connection = duckdb.connect(
+                database=settings.DUCKDB_PATH.as_posix(),
+                read_only=True,
+                config=_duckdb_config(),
+            )
+    return _connection
+
+
+def _acquire_cursor() -> duckdb.DuckDBPyConnection:
+    global _pool_created
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+
+    with _pool_lock:
+        create = _pool_created < settings.DUCKDB_POOL_SIZE
+        if create:
+            _pool_created += 1
+
+    if create:
+        log.info("duckdb.new_cursor", pool_size=_pool_created)
+        try:
+            return _get_shared_connection().cursor()
+        except Exception:
+            # give the slot back, otherwise failed attempts would exhaust the pool
+            with _pool_lock:
+                _pool_created -= 1
+            raise
+
+    # pool is exhausted, wait for another request to return its cursor
+    try:
+        return _pool.get(timeout=settings.DUCKDB_POOL_TIMEOUT)
+    except queue.Empty:
+        raise HTTPException(
+            status_code=503, detail="no database connection available, try again later"
+        )
+
+
+@contextmanager
+def checkout() -> Iterator[duckdb.DuckDBPyConnection]:
+    """Borrow a read-only cursor from the pool for the duration of the block."""
+    con = _acquire_cursor()
+    try:
+        yield con
+    finally:
+        _pool.put(con)
+
+
+def fetchone_dict(con: duckdb.DuckDBPyConnection) -> Optional[dict]:
+    """Fetch a single row of executed query as a dict, much cheaper than `fetch_df`."""
+    row = con.fetchone()
+    if row is None:
+        return None
+    return dict(zip((col[0] for col in con.description), row))
+
+
+def fetchall_dicts(con: duckdb.DuckDBPyConnection) -> list[dict]:
+    """Fetch all rows of executed query as a list of dicts, cheaper than `fetch_df` for
+    small results."""
+    cols = [col[0] for col in con.description]
+    return [dict(zip(cols, row)) for row in con.fetchall()]
+
+
+class BytesLRUCache:
+    """Thread-safe LRU cache of serialized responses bounded by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._data: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def fits(self, size: int) -> bool:
+        # don't let a single huge response evict everything else
+        return size <= self.max_bytes // 4
+
+    def set(self, key: Hashable, value: bytes) -> None:
+        if not self.fits(len(value)):
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= len(self._data.pop(key))
+            self._data[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+
+T = TypeVar("T")
+
+
+def ttl_cache(
+    maxsize: int, ttl: float
+) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Like `functools.lru_cache`, but entries expire after `ttl` seconds. Exceptions
+    are not cached."""
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        cache: "OrderedDict[Hashable, tuple[float, T]]" = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args: Hashable) -> T:
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+                if hit is not None and hit[0] > now:
+                    cache.move_to_end(args)
+                    return hit[1]
+
+            value = func(*args)
+
+            with lock:
+                cache[args] = (now + ttl, value)
+                cache.move_to_end(args)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return value
+
+        wrapper.cache_clear = cache.clear  # type: ignore
+        return wrapper
+
+    return decorator
+
+
+def etag(checksum: str) -> str:
+    return f'"{checksum}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Return `304 Not Modified` response if client already has the current version,
+    call this before running any expensive queries."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or etag in (_opaque_tag(tag) for tag in if_none_match.split(","))
+    ):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
 
 
-@functools.cache
-def get_readonly_connection(thread_id: int) -> duckdb.DuckDBPyConnection:
-    # duckdb connection is not threadsafe, we have to create one connection per thread
-    log.info("duckdb.new_connection", thread_id=thread_id)
-    return duckdb.connect(database=settings.DUCKDB_PATH.as_posix(), read_only=True)
+def _opaque_tag(tag: str) -> str:
+    # If-None-Match uses weak comparison, i.e. `W/"abc"` matches `"abc"`
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
 
 
 def omit_nullable_values(d: dict) -> dict:
-    return {k: v for k, v in d.items() if v is not None and not pd.isna(v)}
+    # NaN is the only value not equal to itself, this is much cheaper than `pd.isna`
+    return {k: v for k, v in d.items() if v is not None and v == v}
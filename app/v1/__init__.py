@@ -9,6 +9,10 @@ from .search import router as search_router
 
 v1 = FastAPI(default_response_class=utils.ORJSONResponse)
 
+# JSON and CSV responses compress very well, small responses are not worth it. Responses
+# are compressed on the event loop, keep the level moderate to not block other requests
+v1.add_middleware(utils.GZipMiddleware, minimum_size=1024, compresslevel=6)
+
 v1.include_router(metadata_router)
 v1.include_router(data_router)
 v1.include_router(search_router)
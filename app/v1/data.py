@@ -1,15 +1,19 @@
+import functools
+import hashlib
 import io
-import threading
-from typing import Any, Literal, Optional, cast
+import os
+import tempfile
+from typing import Any, Dict, Iterator, Literal, Optional, Tuple
 
-import pandas as pd
 import pyarrow as pa
+import pyarrow.csv as pa_csv
 import structlog
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pyarrow.feather import write_feather
 
 from app import utils
+from app.core.config import settings
 from crawler.utils import sanitize_table_path
 
 from .schemas import VariableDataResponse
@@ -17,34 +21,126 @@ from .schemas import VariableDataResponse
 log = structlog.get_logger()
 
 
-DATA_TYPES = Literal["csv", "feather", "feather_direct", "json"]
+DATA_TYPES = Literal["arrow", "csv", "feather", "feather_direct", "json"]
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# default limit of table data, high enough to return all rows
+DEFAULT_LIMIT = 1000000000
+
+# zstd level 1 compresses almost as well as the default level 3, but much faster,
+# which matters more when files are compressed on every request
+FEATHER_COMPRESSION = "zstd"
+FEATHER_COMPRESSION_LEVEL = 1
 
 router = APIRouter()
 
+# serialized variable data, checksum in the key makes sure that we never serve stale data
+_variable_data_cache = utils.BytesLRUCache(max_bytes=settings.DATA_CACHE_MAX_BYTES)
+
+
+class _ChunkSink:
+    """Minimal writable file object that collects written bytes until they are drained."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
 
-def _read_sql_bytes(con, sql: str, parameters) -> io.BytesIO:
-    """Execute SQL and return BytesIO object with byte data."""
-    sink = io.BytesIO()
+def _stream_sql_batches(con, sql: str, parameters, new_writer) -> Iterator[bytes]:
+    """Execute SQL and return iterator of bytes written by `new_writer(sink, schema)`
+    (e.g. Arrow IPC file or CSV writer) one record batch at a time without holding
+    the whole file in memory."""
+    # response body is consumed after the endpoint returns and from a different thread,
+    # use a separate cursor so that we don't share it with other requests
+    cursor = con.cursor()
+    try:
+        # DuckDB row groups have 122880 rows
+        batch_iterator = cursor.execute(sql, parameters=parameters).fetch_record_batch(
+            chunk_size=122880
+        )
+    except Exception:
+        cursor.close()
+        raise
+    return _write_batches(cursor, batch_iterator, new_writer)
+
+
+def _write_batches(cursor, batch_iterator, new_writer) -> Iterator[bytes]:
+    try:
+        sink = _ChunkSink()
+        schema = _signed_dictionary_schema(batch_iterator.schema)
+        with new_writer(sink, schema) as writer:
+            for rb in batch_iterator:
+                if rb.schema != schema:
+                    rb = pa.Table.from_batches([rb]).cast(schema)
+                writer.write(rb)
+                yield sink.drain()
+        # e.g. footer of feather file is written when the writer is closed
+        yield sink.drain()
+    finally:
+        cursor.close()
+
+
+def _new_feather_writer(sink, schema) -> pa.ipc.RecordBatchFileWriter:
+    # compress buffers in the file itself, readers decompress them transparently
+    codec = pa.Codec(FEATHER_COMPRESSION, compression_level=FEATHER_COMPRESSION_LEVEL)
+    return pa.ipc.new_file(
+        sink, schema, options=pa.ipc.IpcWriteOptions(compression=codec)
+    )
 
-    batch_iterator = con.execute(sql, parameters=parameters).fetch_record_batch(
-        chunk_size=1000
+
+def _write_feather(tb: pa.Table, dest) -> None:
+    write_feather(
+        _signed_dictionary_indices(tb),
+        dest,
+        compression=FEATHER_COMPRESSION,
+        compression_level=FEATHER_COMPRESSION_LEVEL,
     )
-    with pa.ipc.new_file(sink, batch_iterator.schema) as writer:
-        for rb in batch_iterator:
-            writer.write_batch(rb)
 
-    sink.seek(0)
 
-    return sink
+def _signed_dictionary_indices(tb: pa.Table) -> pa.Table:
+    return tb.cast(_signed_dictionary_schema(tb.schema))
 
 
-def _bytes_to_response(bytes_io: io.BytesIO) -> StreamingResponse:
-    # NOTE: using raw `bytes_io` should be in theory faster than `iter([bytes_io.getvalue()])`, yet
-    # it is much slower for unknown reasons
-    # response = StreamingResponse(bytes_io, media_type="application/octet-stream")
-    response = StreamingResponse(
-        iter([bytes_io.getvalue()]), media_type="application/octet-stream"
+def _signed_dictionary_schema(schema: pa.Schema) -> pa.Schema:
+    """DuckDB exports categoricals as dictionaries with unsigned indices which pandas
+    can't read (see https://github.com/duckdb/duckdb/issues/4130), use signed instead."""
+    return pa.schema(
+        [
+            f.with_type(pa.dictionary(pa.int32(), f.type.value_type, f.type.ordered))
+            if pa.types.is_dictionary(f.type)
+            else f
+            for f in schema
+        ]
     )
+
+
+def _bytes_to_response(bytes_io: io.BytesIO) -> Response:
+    # NOTE: streaming raw `bytes_io` is very slow, because iterating over a file object
+    # yields it line by line (i.e. split on every newline byte in binary data). The
+    # whole file is in memory anyway, so send it in one piece with Content-Length
+    response = Response(bytes_io.getvalue(), media_type="application/octet-stream")
     response.headers["Content-Disposition"] = "attachment; filename=owid.feather"
     return response
 
@@ -52,42 +148,48 @@ def _bytes_to_response(bytes_io: io.BytesIO) -> StreamingResponse:
 def _sql_to_response(
     con, sql: str, type: DATA_TYPES, parameters: list[Any] = []
 ) -> Any:
-    # read data in feather format and return it directly in response
-    # NOTE: should be the fastest in theory, but is really slow for unknown reasons
+    # stream record batches as feather file, it's written and sent one batch at a time
+    # without holding the whole file in memory
     if type == "feather_direct":
-        # WARNING: this does not support categorical variables and raises `pyarrow.lib.ArrowTypeError`
-        # when you try to read it with pandas (see https://github.com/duckdb/duckdb/issues/4130)
-        # we'd have to either convert categoricals into strings or change format while still in arrow format
-        bytes_io = _read_sql_bytes(con, sql, parameters=parameters)
-        return _bytes_to_response(bytes_io)
+        response = StreamingResponse(
+            _stream_sql_batches(con, sql, parameters, _new_feather_writer),
+            media_type="application/octet-stream",
+        )
+        response.headers["Content-Disposition"] = "attachment; filename=owid.feather"
+        return response
+
+    # stream record batches in Arrow IPC stream format, clients can start reading them
+    # before the whole result is sent
+    elif type == "arrow":
+        return StreamingResponse(
+            _stream_sql_batches(con, sql, parameters, pa.ipc.new_stream),
+            media_type=ARROW_STREAM_MEDIA_TYPE,
+        )
 
-    # read data into dataframe and then convert to feather
+    # read data into arrow table and write it as feather, no need to go through dataframe
     elif type == "feather":
         bytes_io = io.BytesIO()
-        df = con.execute(sql, parameters=parameters).fetch_df()
-        write_feather(df, bytes_io)
+        tb = con.execute(sql, parameters=parameters).fetch_arrow_table()
+        _write_feather(tb, bytes_io)
         return _bytes_to_response(bytes_io)
 
-    # read data into dataframe and then convert to csv
+    # write record batches to csv with pyarrow, no need to go through dataframe
     elif type == "csv":
-        df = con.execute(sql, parameters=parameters).fetch_df()
-
-        str_stream = io.StringIO()
-        df.to_csv(str_stream, index=False)
-
-        return StreamingResponse(iter([str_stream.getvalue()]), media_type="text/csv")
+        return StreamingResponse(
+            _stream_sql_batches(con, sql, parameters, pa_csv.CSVWriter),
+            media_type="text/csv",
+        )
 
-    # read data into dataframe and then convert to json
+    # read data into numpy arrays and serialize them directly with orjson
     elif type == "json":
-        # NOTE: we could also do this directly from pyarrow, but it is slower than to pandas
+        # NOTE: we could also do this directly from pyarrow, but it is slower than numpy
         # for some reason
         # return con.execute(sql, parameters=parameters).fetch_arrow_table().to_pydict()
 
-        df = con.execute(sql, parameters=parameters).fetch_df()
-
-        # TODO: converting to lists and then ormjson is slow, we could instead
-        # convert to numpy arrays on which ormjson is super fast
-        return df.to_dict(orient="list")
+        # return response directly, FastAPI can't encode numpy arrays by itself
+        return utils.ORJSONResponse(
+            content=con.execute(sql, parameters=parameters).fetchnumpy()
+        )
 
     else:
         raise HTTPException(status_code=400, detail=f"unknown type {type}")
@@ -96,34 +198,76 @@ def _sql_to_response(
 @router.post("/sql")
 def sql_query(sql: str, type: DATA_TYPES = "csv"):
     """Run arbitrary query on top of our database."""
-    con = utils.get_readonly_connection(threading.get_ident())
-    return _sql_to_response(con, sql, type)
+    with utils.checkout() as con:
+        return _sql_to_response(con, sql, type)
 
 
 # QUESTION: how about /variable/{variable_id}/data?
 @router.get(
     "/variableById/data/{variable_id}",
-    response_model=VariableDataResponse,
-    response_model_exclude_unset=True,
+    # only document the response, it is returned directly without validation
+    responses={200: {"model": VariableDataResponse}},
 )
-def data_for_backported_variable(variable_id: int, limit: Optional[int] = None):
+def data_for_backported_variable(
+    request: Request, variable_id: int, limit: Optional[int] = None
+):
     """Fetch data for a single variable."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
+    short_name, table_db_name, checksum = _resolve_variable(variable_id)
+
+    etag = utils.etag(checksum)
+    not_modified = utils.not_modified(request, etag)
+    if not_modified:
+        return not_modified
+
+    cache_key = (variable_id, checksum, limit)
+    body = _variable_data_cache.get(cache_key)
+    if body is not None:
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    q = _variable_data_sql(short_name, table_db_name, limit=bool(limit))
+    parameters = [limit] if limit else []
 
-    # get meta about variable
+    # skip pandas and let orjson serialize numpy arrays
+    with utils.checkout() as con:
+        columns = con.execute(q, parameters=parameters).fetchnumpy()
+    pieces = list(_stream_json_columns(columns))
+
+    if _variable_data_cache.fits(sum(len(p) for p in pieces)):
+        body = b"".join(pieces)
+        _variable_data_cache.set(cache_key, body)
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    # too large to be cached, send serialized columns one by one without joining them
+    return StreamingResponse(
+        iter(pieces), media_type="application/json", headers={"ETag": etag}
+    )
+
+
+@utils.ttl_cache(maxsize=4096, ttl=60)
+def _resolve_variable(variable_id: int) -> Tuple[str, str, str]:
+    """Get short name and table of a variable and checksum of its dataset. This is
+    needed by every request (checksum is used as ETag), so keep them in memory for
+    a while."""
     q = """
     select
-        variable_id,
-        short_name,
-        table_db_name
-    from meta_variables
-    where variable_id = (?)
+        v.short_name,
+        v.table_db_name,
+        d.checksum
+    from meta_variables as v
+    join meta_datasets as d on d.path = v.dataset_path
+    where v.variable_id = (?)
     """
-    df = cast(pd.DataFrame, con.execute(q, parameters=[variable_id]).fetch_df())
-    _assert_single_variable(df.shape[0], variable_id)
-    r = dict(df.iloc[0])
+    with utils.checkout() as con:
+        rows = con.execute(q, parameters=[variable_id]).fetchall()
+    _assert_single_variable(len(rows), variable_id)
+    return rows[0]
+
 
+@functools.lru_cache(maxsize=1024)
+def _variable_data_sql(short_name: str, table_db_name: str, limit: bool) -> str:
+    # NOTE: duckdb python API doesn't let us keep prepared statements around, at least
+    # don't rebuild SQL of the same variables over and over
     # TODO: DuckDB / SQLite doesn't allow parameterized table or column names, how do we escape it properly?
     # is it even needed if we get them from our DB and it is read-only?
     q = f"""
@@ -132,16 +276,25 @@ def data_for_backported_variable(variable_id: int, limit: Optional[int] = None):
         entity_name as entity_names,
         entity_id as entities,
         entity_code as entity_codes,
-        {r["short_name"]} as values
-    from {r["table_db_name"]}
-    where {r["short_name"]} is not null
+        {short_name} as values
+    from {table_db_name}
+    where {short_name} is not null
     """
-    parameters = []
     if limit:
         q += "limit (?)"
-        parameters.append(limit)
-    df = cast(pd.DataFrame, con.execute(q, parameters=parameters).fetch_df())
-    return df.to_dict(orient="list")
+    return q
+
+
+def _stream_json_columns(columns: Dict[str, Any]) -> Iterator[bytes]:
+    """Serialize dictionary of columns into JSON object one column at a time, orjson
+    serializes numpy arrays directly without converting them to lists first."""
+    yield b"{"
+    for i, (name, values) in enumerate(columns.items()):
+        if i > 0:
+            yield b","
+        yield utils.orjson_dumps(name) + b":"
+        yield utils.orjson_dumps(values)
+    yield b"}"
 
 
 # NOTE: it might be more intuitive to have paths like this
@@ -153,31 +306,112 @@ def data_for_backported_variable(variable_id: int, limit: Optional[int] = None):
     "/dataset/data/{channel}/{namespace}/{version}/{dataset}/{table}.{type}",
 )
 def data_for_etl_table(
+    request: Request,
     channel: str,
     namespace: str,
     version: str,
     dataset: str,
     table: str,
     columns: str = "*",
-    limit: int = 1000000000,
+    limit: int = DEFAULT_LIMIT,
     type: DATA_TYPES = "csv",
 ):
-    """Fetch data for a table."""
+    """Fetch data for a table.
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    table_db_name = sanitize_table_path(
-        f"{channel}/{namespace}/{version}/{dataset}/{table}"
+    CSV is written by pyarrow: strings are quoted, missing values are empty, booleans
+    are `true`/`false` and whole floats are written without decimals (e.g. `3280000`),
+    pass explicit dtypes to your CSV reader if you need floats.
+    """
+
+    table_path = f"{channel}/{namespace}/{version}/{dataset}/{table}"
+
+    # clients that can read Arrow can ask for it instead of JSON
+    if type == "json" and ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", ""):
+        type = "arrow"
+
+    with utils.checkout() as con:
+        # check ETag before reading any data, the same URL can return JSON or Arrow
+        # depending on `Accept` header so the type must be part of it
+        etag = utils.etag(f"{_table_checksum(con, table_path)}-{type}")
+        not_modified = utils.not_modified(request, etag)
+        if not_modified:
+            not_modified.headers["Vary"] = "Accept"
+            return not_modified
+
+        sql = _etl_table_sql(table_path, columns)
+
+        # only cache whole tables, caching every combination of columns and limit chosen
+        # by clients would let them fill up the disk
+        if (
+            type == "feather"
+            and settings.FEATHER_CACHE_DIR
+            and columns == "*"
+            and limit == DEFAULT_LIMIT
+        ):
+            cache_key = f"{table_path}/{etag}"
+            response = _cached_feather_response(con, sql, [limit], cache_key)
+        else:
+            response = _sql_to_response(con, sql, type, [limit])
+        response.headers["ETag"] = etag
+        response.headers["Vary"] = "Accept"
+        return response
+
+
+def _cached_feather_response(
+    con, sql: str, parameters: list[Any], cache_key: str
+) -> FileResponse:
+    """Write feather file to disk only once and then serve it from there, dataset checksum
+    should be part of `cache_key` to never serve stale data."""
+    assert settings.FEATHER_CACHE_DIR
+    path = (
+        settings.FEATHER_CACHE_DIR
+        / f"{hashlib.sha256(cache_key.encode()).hexdigest()}.feather"
+    )
+
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tb = con.execute(sql, parameters=parameters).fetch_arrow_table()
+        # write to a temporary file first and rename it, concurrent requests for the same
+        # table must never see a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                _write_feather(tb, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    return FileResponse(
+        path, media_type="application/octet-stream", filename="owid.feather"
     )
-    sql = f"""
+
+
+def _table_checksum(con, table_path: str) -> str:
+    q = """
+    select
+        d.checksum
+    from meta_tables as t
+    join meta_datasets as d on d.path = t.dataset_path
+    where t.path = (?)
+    """
+    row = con.execute(q, parameters=[table_path]).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"table `{table_path}` not found")
+    return row[0]
+
+
+@functools.lru_cache(maxsize=1024)
+def _etl_table_sql(table_path: str, columns: str) -> str:
+    # the same tables are requested over and over, don't rebuild their SQL every time
+    table_db_name = sanitize_table_path(table_path)
+    return f"""
     select
         {columns}
     from {table_db_name}
     limit (?)
     """
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    return _sql_to_response(con, sql, type, [limit])
-
 
 def _assert_single_variable(n, variable_id):
     if n == 0:
@@ -1,4 +1,4 @@
-import threading
+import functools
 
 from fastapi import APIRouter
 
@@ -12,12 +12,36 @@ router = APIRouter()
     "/datasets",
 )
 def list_all_datasets():
-    con = utils.get_readonly_connection(threading.get_ident())
     sql = """
     select title from meta_datasets
     """
-    df = con.execute(sql).fetch_df()
-    return {"datasets": list(df.title)}
+    with utils.checkout() as con:
+        rows = con.execute(sql).fetchall()
+    return {"datasets": [r[0] for r in rows]}
+
+
+@functools.lru_cache(maxsize=1)
+def _catalog() -> dict:
+    """Tree of channels, namespaces, versions, datasets and tables from `meta_tables`.
+    Database is read-only and the tree is small, so we load it only once and serve all
+    list endpoints from memory."""
+    sql = """
+    select distinct channel, namespace, version, dataset_name, table_name
+    from meta_tables
+    """
+    with utils.checkout() as con:
+        rows = con.execute(sql).fetchall()
+
+    catalog: dict = {}
+    for channel, namespace, version, dataset, table in rows:
+        tables = (
+            catalog.setdefault(channel, {})
+            .setdefault(namespace, {})
+            .setdefault(version, {})
+            .setdefault(dataset, {})
+        )
+        tables[table] = None
+    return catalog
 
 
 @router.get(
@@ -26,12 +50,7 @@ def list_all_datasets():
 def list_channels():
     """List all available channels."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    sql = """
-    select distinct channel from meta_tables
-    """
-    df = con.execute(sql).fetch_df()
-    return {"channels": list(df.channel)}
+    return {"channels": list(_catalog())}
 
 
 @router.get(
@@ -40,13 +59,7 @@ def list_channels():
 def list_namespaces(channel: str):
     """List all available namespaces."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    sql = """
-    select distinct namespace from meta_tables
-    where channel = (?)
-    """
-    df = con.execute(sql, parameters=[channel]).fetch_df()
-    return {"namespaces": list(df.namespace)}
+    return {"namespaces": list(_catalog().get(channel, {}))}
 
 
 @router.get(
@@ -55,13 +68,7 @@ def list_namespaces(channel: str):
 def list_versions(channel: str, namespace: str):
     """List all available versions."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    sql = """
-    select distinct version from meta_tables
-    where channel = (?) and namespace = (?)
-    """
-    df = con.execute(sql, parameters=[channel, namespace]).fetch_df()
-    return {"versions": list(df.version)}
+    return {"versions": list(_catalog().get(channel, {}).get(namespace, {}))}
 
 
 @router.get(
@@ -70,13 +77,8 @@ def list_versions(channel: str, namespace: str):
 def list_datasets(channel: str, namespace: str, version: str):
     """List all available datasets."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    sql = """
-    select distinct dataset_name from meta_tables
-    where channel = (?) and namespace = (?) and version = (?)
-    """
-    df = con.execute(sql, parameters=[channel, namespace, version]).fetch_df()
-    return {"datasets": list(df.dataset_name)}
+    versions = _catalog().get(channel, {}).get(namespace, {})
+    return {"datasets": list(versions.get(version, {}))}
 
 
 @router.get(
@@ -85,10 +87,5 @@ def list_datasets(channel: str, namespace: str, version: str):
 def list_tables(channel: str, namespace: str, version: str, dataset: str):
     """List all available tables."""
 
-    con = utils.get_readonly_connection(threading.get_ident())
-    sql = """
-    select distinct table_name from meta_tables
-    where channel = (?) and namespace = (?) and version = (?) and dataset_name = (?)
-    """
-    df = con.execute(sql, parameters=[channel, namespace, version, dataset]).fetch_df()
-    return {"tables": list(df.table_name)}
+    versions = _catalog().get(channel, {}).get(namespace, {})
+    return {"tables": list(versions.get(version, {}).get(dataset, {}))}
@@ -1,20 +1,14 @@
-import json
-import threading
-from typing import Any, Dict, cast
+from typing import Any, Dict, Optional
 
 import numpy as np
-import pandas as pd
+import orjson
 import structlog
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import Response
 
 from app import utils
 
-from .schemas import (
-    Dimension,
-    DimensionProperties,
-    VariableMetadataResponse,
-    VariableSource,
-)
+from .schemas import VariableMetadataResponse
 
 log = structlog.get_logger()
 
@@ -24,6 +18,11 @@ router = APIRouter()
 # NOTE: duckdb also supports python relations, would it be helpful?
 # https://github.com/duckdb/duckdb/blob/master/examples/python/duckdb-python.py
 
+# NOTE: we'd like to prepare metadata queries once and reuse them, but duckdb python API
+# doesn't expose prepared statements (`execute` prepares the query on every call) and
+# SQL `EXECUTE name(?)` doesn't accept bound parameters, so we'd have to interpolate
+# user input into SQL
+
 
 @router.get(
     "/dataset/metadata/{channel}/{namespace}/{version}/{dataset}/{table}",
@@ -39,22 +38,38 @@ def metadata_for_etl_variable(
 ):
     table_path = f"{channel}/{namespace}/{version}/{dataset}/{table}"
 
-    con = utils.get_readonly_connection(threading.get_ident())
+    with utils.checkout() as con:
+        variables = _metadata_etl_variables(con, table_path)
+        t = _metadata_etl_table(con, table_path)
+        d = _metadata_etl_dataset(con, channel, namespace, version, dataset)
 
-    vf = _metadata_etl_variables(con, table_path)
-    tf = _metadata_etl_table(con, table_path)
-    df = _metadata_etl_dataset(con, channel, namespace, version, dataset)
-
-    if df.empty:
+    if d is None or t is None:
         raise HTTPException(status_code=404, detail=f"table `{table_path}` not found")
 
     return {
-        "dataset": df.iloc[0].to_dict(),
-        "table": tf.iloc[0].to_dict(),
-        "variables": vf.to_dict(orient="records"),
+        "dataset": d,
+        "table": t,
+        "variables": variables,
     }
 
 
+# JSON columns are parsed only once in python instead of extracting every field with
+# a separate `->>` in SQL, only timestamps are left to DuckDB to parse
+_Q_BACKPORTED_VARIABLE_METADATA = """
+SELECT
+    v.grapher_meta,
+    TRY_CAST(v.grapher_meta->>'$.createdAt' AS timestamp) as createdAt,
+    TRY_CAST(v.grapher_meta->>'$.updatedAt' AS timestamp) as updatedAt,
+    v.sources,
+    v.variable_type,
+    v.dimension_values,
+    d.grapher_meta as dataset_grapher_meta,
+FROM meta_variables as v
+JOIN meta_datasets as d ON d.short_name = v.dataset_short_name
+WHERE v.variable_id = (?)
+"""
+
+
 # QUESTION: how about `/variable/{variable_id}/metadata` naming?
 @router.get(
     "/variableById/metadata/{variable_id}",
@@ -65,114 +80,136 @@ def metadata_for_backported_variable(variable_id: int):
     """Fetch metadata for a single variable from database.
     This function is identical to Variables.getVariableData in owid-grapher repository
     """
-    q = """
-    SELECT
-        -- variables
-        v.grapher_meta->>'$.name' as name,
-        v.grapher_meta->>'$.unit' as unit,
-        v.grapher_meta->>'$.description' as description,
-        v.grapher_meta->>'$.createdAt' as createdAt,
-        v.grapher_meta->>'$.updatedAt' as updatedAt,
-        v.grapher_meta->>'$.code' as code,
-        v.grapher_meta->>'$.coverage' as coverage,
-        v.grapher_meta->>'$.timespan' as timespan,
-        (v.grapher_meta->>'$.datasetId')::integer as datasetId,
-        (v.grapher_meta->>'$.sourceId')::integer as sourceId,
-        v.grapher_meta->>'$.shortUnit' as shortUnit,
-        v.grapher_meta->>'$.display' as display,
-        (v.grapher_meta->>'$.columnOrder')::integer as columnOrder,
-        v.grapher_meta->>'$.originalMetadata' as originalMetadata,
-        v.grapher_meta->>'$.grapherConfig' as grapherConfig,
-        -- dataset
-        d.grapher_meta->>'$.name' as datasetName,
-        IF(d.grapher_meta->>'$.nonRedistributable' = 'true', true, false) as nonRedistributable,
-        -- there should be always only one source for variable
-        -- this is inverse of `convert_grapher_source`
-        v.sources->>'$[0].name' as sourceName,
-        v.sources->>'$[0].description' as sourceAdditionalInfo,
-        v.sources->>'$[0].date_accessed' as sourceRetrievedDate,
-        v.sources->>'$[0].url' as sourceLink,
-        v.sources->>'$[0].publisher_source' as sourceDataPublisherSource,
-        v.sources->>'$[0].published_by' as sourceDataPublishedBy,
-    FROM meta_variables as v
-    JOIN meta_datasets as d ON d.short_name = v.dataset_short_name
-    WHERE v.variable_id = (?)
-    """
-    con = utils.get_readonly_connection(threading.get_ident())
+    # data come from our own DB and already have the shape of `VariableMetadataResponse`,
+    # return them directly to skip validation against `response_model` which is only
+    # kept for docs
+    return Response(
+        content=_backported_variable_metadata(variable_id),
+        media_type="application/json",
+    )
+
 
-    # TODO: this is a hacky and slow way to do it, use ORM or proper dataclass instead
-    df = cast(pd.DataFrame, con.execute(q, parameters=[variable_id]).fetch_df())
+# grapher requests metadata of the same variables over and over and database is
+# read-only, keep serialized responses for a while instead of parsing dimension values
+# with thousands of entities again
+@utils.ttl_cache(maxsize=1024, ttl=60)
+def _backported_variable_metadata(variable_id: int) -> bytes:
+    with utils.checkout() as con:
+        # TODO: this is a hacky way to do it, use ORM or proper dataclass instead
+        row = utils.fetchone_dict(
+            con.execute(_Q_BACKPORTED_VARIABLE_METADATA, parameters=[variable_id])
+        )
 
-    if df.empty:
+    if row is None:
         raise HTTPException(
             status_code=404, detail=f"variableId `{variable_id}` not found"
         )
 
-    # null values in JSON string functions end up as "null" string, fix that
-    df = df.replace("null", np.nan)
-    row = df.iloc[0].to_dict()
-
-    source = VariableSource(
-        id=row.pop("sourceId"),
-        name=row.pop("sourceName"),
-        dataPublishedBy=row.pop("sourceDataPublishedBy", ""),
-        dataPublisherSource=row.pop("sourceDataPublisherSource", ""),
-        link=row.pop("sourceLink", ""),
-        retrievedDate=row.pop("sourceRetrievedDate", ""),
-        additionalInfo=row.pop("sourceAdditionalInfo", ""),
-    )
+    meta = _loads_or_empty(row["grapher_meta"])
+    dataset_meta = _loads_or_empty(row["dataset_grapher_meta"])
+
+    # there should be always only one source for variable
+    # this is inverse of `convert_grapher_source`
+    sources = _loads_or_empty(row["sources"])
+    s = sources[0] if sources else {}
+    source = {
+        "id": _int_or_none(meta.get("sourceId")),
+        "name": s.get("name") or "",
+        "dataPublishedBy": s.get("published_by") or "",
+        "dataPublisherSource": s.get("publisher_source") or "",
+        "link": s.get("url") or "",
+        "retrievedDate": s.get("date_accessed") or "",
+        "additionalInfo": s.get("description") or "",
+    }
 
-    nonRedistributable = row.pop("nonRedistributable")
-    displayJson = row.pop("display")
-    variable = utils.omit_nullable_values(row)
+    variable = utils.omit_nullable_values(
+        {
+            "name": meta.get("name"),
+            "unit": meta.get("unit"),
+            "description": meta.get("description"),
+            "createdAt": row["createdAt"],
+            "updatedAt": row["updatedAt"],
+            "code": meta.get("code"),
+            "coverage": meta.get("coverage"),
+            "timespan": meta.get("timespan"),
+            "datasetId": _int_or_none(meta.get("datasetId")),
+            "shortUnit": meta.get("shortUnit"),
+            "columnOrder": _int_or_none(meta.get("columnOrder")),
+            "originalMetadata": _json_text(meta.get("originalMetadata")),
+            "grapherConfig": _json_text(meta.get("grapherConfig")),
+            "datasetName": dataset_meta.get("name"),
+        }
+    )
 
     # get variable types from duckdb (all metadata would be eventually retrieved in duckdb)
     # NOTE: getting these is a bit of a pain, we have a lot of duplicate information
     # in our DB
-    q = """
-    select
-        variable_type,
-        dimension_values
-    from meta_variables where variable_id = (?)
-    """
-    variable_type, dimension_values = con.execute(q, parameters=[variable_id]).fetchone()  # type: ignore
+    # NOTE: dimension values can have thousands of entities, orjson parses them much
+    # faster than json and unnesting them in DuckDB would only add rows to fetch
+    dimensions = _parse_dimension_values(orjson.loads(row["dimension_values"]))
+
+    return utils.orjson_dumps(
+        {
+            **variable,
+            "nonRedistributable": str(dataset_meta.get("nonRedistributable")).lower()
+            == "true",
+            "display": meta.get("display"),
+            "source": source,
+            "type": row["variable_type"],
+            "dimensions": dimensions,
+        }
+    )
 
-    dimensions = _parse_dimension_values(json.loads(dimension_values))
 
-    return VariableMetadataResponse(
-        nonRedistributable=bool(nonRedistributable),
-        display=json.loads(displayJson),
-        source=source,
-        type=variable_type,
-        dimensions=dimensions,
-        **variable,
-    )
+def _loads_or_empty(s: Optional[str]) -> Any:
+    return orjson.loads(s) if s is not None else {}
+
 
+def _loads_or_none(s: Optional[str]) -> Any:
+    # JSON columns can be NULL, e.g. `display` of variables without display settings
+    return orjson.loads(s) if s is not None else None
 
-def _parse_dimension_values(dimension_values: Any) -> Dict[str, Dimension]:
+
+def _int_or_none(v: Any) -> Optional[int]:
+    return int(v) if v is not None else None
+
+
+def _json_text(v: Any) -> Optional[str]:
+    # `->>` used to return nested objects as compact JSON text, keep it that way
+    if v is None or isinstance(v, str):
+        return v
+    return orjson.dumps(v).decode()
+
+
+def _parse_dimension_values(dimension_values: Any) -> Dict[str, Dict[str, Any]]:
+    """Build dimensions in the shape of `Dimension` schema from their values. Use plain
+    dicts instead of models to skip validation of every single value (there can be
+    thousands of them)."""
     dimensions = {}
 
     # NOTE: we have inconsistency with plurals - even though the dimension name is
     # singular, we use plural in the API (but not for custom dimensions)
     if "year" in dimension_values:
-        dimensions["years"] = Dimension(
-            type="int",
-            values=[DimensionProperties(id=y) for y in dimension_values.pop("year")],
-        )
+        dimensions["years"] = {
+            "type": "int",
+            "values": [{"id": y} for y in dimension_values.pop("year")],
+        }
 
     # special case of entities backported variables with entities and their codes
     if {"entity_id", "entity_name", "entity_code"} <= set(dimension_values.keys()):
-        dimensions["entities"] = Dimension(
-            type="int",
-            values=[
-                DimensionProperties(id=int(e[0]), name=e[1], code=e[2])
-                for e in zip(
-                    dimension_values.pop("entity_id"),
+        # cast ids to int in a single numpy pass instead of calling `int` on every one
+        entity_ids = np.asarray(dimension_values.pop("entity_id"), dtype=np.int64)
+        dimensions["entities"] = {
+            "type": "int",
+            "values": [
+                {"id": i, "name": name, "code": code}
+                for i, name, code in zip(
+                    entity_ids.tolist(),
                     dimension_values.pop("entity_name"),
                     dimension_values.pop("entity_code"),
                 )
             ],
-        )
+        }
 
     assert not dimension_values, (
         "This currently works only for backported datasets with dimensions "
@@ -182,99 +219,108 @@ def _parse_dimension_values(dimension_values: Any) -> Dict[str, Dimension]:
     return dimensions
 
 
-def _metadata_etl_variables(con, table_path):
-    q = """
-    SELECT
-        -- variables (commented columns are not relevant for ETL tables)
-        v.title,
-        v.description,
-        v.licenses,
-        v.sources,
-        v.unit,
-        v.short_unit,
-        -- conversion factor from display is needed for CO2 datasets, but honestly it would be
-        -- better to hide it or do the calculation implicitly
-        v.display,
-        -- v.grapher_meta,
-        -- v.variable_id,
-        v.short_name,
-        v.table_path,
-        v.table_db_name,
-        v.dataset_short_name,
-        v.variable_type,
-        -- TODO: should we include `dimension_values` in response or do we only need it for backported variables?
-        -- v.dimension_values,
-    FROM meta_variables as v
-    WHERE v.table_path = (?)
-    """
-
-    # TODO: this is a hacky and slow way to do it, use ORM or proper dataclass instead
-    vf = cast(pd.DataFrame, con.execute(q, parameters=[table_path]).fetch_df())
+_Q_ETL_VARIABLES = """
+SELECT
+    -- variables (commented columns are not relevant for ETL tables)
+    v.title,
+    v.description,
+    v.licenses,
+    v.sources,
+    v.unit,
+    v.short_unit,
+    -- conversion factor from display is needed for CO2 datasets, but honestly it would be
+    -- better to hide it or do the calculation implicitly
+    v.display,
+    -- v.grapher_meta,
+    -- v.variable_id,
+    v.short_name,
+    v.table_path,
+    v.table_db_name,
+    v.dataset_short_name,
+    v.variable_type,
+    -- TODO: should we include `dimension_values` in response or do we only need it for backported variables?
+    -- v.dimension_values,
+FROM meta_variables as v
+WHERE v.table_path = (?)
+"""
+
+
+def _metadata_etl_variables(con, table_path) -> list[dict]:
+    # TODO: this is a hacky way to do it, use ORM or proper dataclass instead
+    variables = utils.fetchall_dicts(
+        con.execute(_Q_ETL_VARIABLES, parameters=[table_path])
+    )
 
     # convert JSON to dict (should be done automatically once we switch to ORM)
-    for col in ("licenses", "sources", "display"):
-        vf[col] = vf[col].apply(json.loads)
-    return vf
-
-
-def _metadata_etl_table(con, table_path):
-    q = """
-    SELECT
-        table_name,
-        dataset_name,
-        table_db_name,
-        version,
-        namespace,
-        channel,
-        dimensions,
-        path,
-        format,
-        is_public,
-    FROM meta_tables as t
-    WHERE path = (?)
-    """
-
-    # TODO: this is a hacky and slow way to do it, use ORM or proper dataclass instead
-    tf = cast(pd.DataFrame, con.execute(q, parameters=[table_path]).fetch_df())
+    for v in variables:
+        for col in ("licenses", "sources", "display"):
+            v[col] = _loads_or_none(v[col])
+    return variables
+
+
+_Q_ETL_TABLE = """
+SELECT
+    table_name,
+    dataset_name,
+    table_db_name,
+    version,
+    namespace,
+    channel,
+    dimensions,
+    path,
+    format,
+    is_public,
+FROM meta_tables as t
+WHERE path = (?)
+"""
+
+
+def _metadata_etl_table(con, table_path) -> Optional[dict]:
+    # TODO: this is a hacky way to do it, use ORM or proper dataclass instead
+    t = utils.fetchone_dict(con.execute(_Q_ETL_TABLE, parameters=[table_path]))
+    if t is None:
+        return None
 
     for col in ("dimensions",):
-        tf[col] = tf[col].apply(json.loads)
-    return tf
-
-
-def _metadata_etl_dataset(con, channel, namespace, version, dataset):
-    q = """
-    SELECT
-        channel,
-        namespace,
-        short_name,
-        title,
-        description,
-        sources,
-        licenses,
-        is_public,
-        checksum,
-        version,
-        -- grapher_meta
-    FROM meta_datasets as d
-    -- TODO: we might want to use path instead of separate columns
-    WHERE channel = (?) and namespace = (?) and version = (?) and short_name = (?)
-    """
-
-    df = cast(
-        pd.DataFrame,
+        t[col] = _loads_or_none(t[col])
+    return t
+
+
+_Q_ETL_DATASET = """
+SELECT
+    channel,
+    namespace,
+    short_name,
+    title,
+    description,
+    sources,
+    licenses,
+    is_public,
+    checksum,
+    version,
+    -- grapher_meta
+FROM meta_datasets as d
+-- TODO: we might want to use path instead of separate columns
+WHERE channel = (?) and namespace = (?) and version = (?) and short_name = (?)
+"""
+
+
+def _metadata_etl_dataset(con, channel, namespace, version, dataset) -> Optional[dict]:
+    d = utils.fetchone_dict(
         con.execute(
-            q,
+            _Q_ETL_DATASET,
             parameters=[
                 channel,
                 namespace,
                 version,
                 dataset,
             ],
-        ).fetch_df(),
+        )
     )
+    if d is None:
+        return None
 
     for col in ("sources", "licenses"):
-        df[col] = df[col].apply(json.loads)
+        d[col] = _loads_or_none(d[col])
 
-    return df
+    return d
@@ -1,7 +1,7 @@
 import datetime as dt
 from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Extra
+from pydantic import BaseModel
 
 
 class VariableDataResponse(BaseModel):
@@ -11,9 +11,6 @@ class VariableDataResponse(BaseModel):
     entity_codes: List[str]
     values: List[Any]
 
-    class Config:
-        extra = Extra.forbid
-
 
 class VariableDisplay(BaseModel):
     name: Optional[str]
@@ -22,9 +19,6 @@ class VariableDisplay(BaseModel):
     includeInTable: Optional[bool]
     conversionFactor: Optional[float]
 
-    class Config:
-        extra = Extra.forbid
-
 
 class VariableSource(BaseModel):
     id: int
@@ -35,26 +29,17 @@ class VariableSource(BaseModel):
     retrievedDate: str
     additionalInfo: str
 
-    class Config:
-        extra = Extra.forbid
-
 
 class DimensionProperties(BaseModel):
     id: int
     name: Optional[str] = None
     code: Optional[str] = None
 
-    class Config:
-        extra = Extra.forbid
-
 
 class Dimension(BaseModel):
     type: str
     values: List[DimensionProperties]
 
-    class Config:
-        extra = Extra.forbid
-
 
 class VariableMetadataResponse(BaseModel):
     name: str
@@ -78,14 +63,11 @@ class VariableMetadataResponse(BaseModel):
     type: str
     dimensions: Dict[str, Dimension]
 
-    class Config:
-        extra = Extra.forbid
-
 
 class SearchResponse(BaseModel):
     variable_name: str
     variable_title: str
-    variable_description: str
+    variable_description: Optional[str]
     variable_unit: str
     table_name: str
     dataset_title: str
@@ -94,13 +76,7 @@ class SearchResponse(BaseModel):
     data_url: str
     match: float
 
-    class Config:
-        extra = Extra.forbid
-
 
 class SearchResponseList(BaseModel):
 
     results: List[SearchResponse]
-
-    class Config:
-        extra = Extra.forbid
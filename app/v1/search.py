@@ -1,4 +1,3 @@
-import threading
 from enum import Enum
 from typing import Optional
 
@@ -32,8 +31,6 @@ def search(
     type: SearchType = SearchType.variable,
     limit: int = 10,
 ):
-    con = utils.get_readonly_connection(threading.get_ident())
-
     # TODO: implement search on other tables too? not sure whether we'll need it yet
     if type != SearchType.variable:
         raise NotImplementedError(
@@ -41,10 +38,12 @@ def search(
         )
 
     if channels:
-        # `parameters` do not support lists (maybe `multiple_parameter_sets` would do?)
-        channels_str = ",".join([f"'{c}'" for c in channels])
-        where = f"and d.channel in ({channels_str})"
+        # `parameters` do not support lists, bind every channel to its own placeholder
+        # so that user input never ends up in SQL
+        placeholders = ", ".join(["?"] * len(channels))
+        where = f"and d.channel in ({placeholders})"
     else:
+        channels = []
         where = ""
 
     # sample search
@@ -67,11 +66,14 @@ def search(
     order by match desc
     limit (?)
     """
-    matches = con.execute(q, parameters=[term, limit]).fetch_df()
-
-    matches["metadata_url"] = "/v1/dataset/metadata/" + matches["table_path"]
-    matches["data_url"] = "/v1/dataset/data/" + matches["table_path"]
+    with utils.checkout() as con:
+        matches = utils.fetchall_dicts(
+            con.execute(q, parameters=[term, *channels, limit])
+        )
 
-    matches = matches.drop(columns=["table_path"])
+    for m in matches:
+        table_path = m.pop("table_path")
+        m["metadata_url"] = f"/v1/dataset/metadata/{table_path}"
+        m["data_url"] = f"/v1/dataset/data/{table_path}"
 
-    return {"results": matches.to_dict(orient="records")}
+    return {"results": matches}
@@ -0,0 +1,98 @@
+import queue
+
+import duckdb
+import pytest
+from fastapi import HTTPException
+
+from app import utils
+from app.core.config import settings
+
+
+@pytest.fixture
+def empty_pool(monkeypatch):
+    monkeypatch.setattr(utils, "_pool", queue.LifoQueue())
+    monkeypatch.setattr(utils, "_pool_created", 0)
+    monkeypatch.setattr(settings, "DUCKDB_POOL_SIZE", 2)
+    monkeypatch.setattr(settings, "DUCKDB_POOL_TIMEOUT", 0.1)
+
+
+def test_checkout_failed_cursors_release_pool(empty_pool, monkeypatch):
+    def _get_shared_connection():
+        raise duckdb.IOException("database can't be opened")
+
+    monkeypatch.setattr(utils, "_get_shared_connection", _get_shared_connection)
+
+    # more failures than the pool size must not exhaust the pool and block forever
+    for _ in range(settings.DUCKDB_POOL_SIZE + 1):
+        with pytest.raises(duckdb.IOException):
+            with utils.checkout():
+                pass
+    assert utils._pool_created == 0
+
+
+def test_checkout_exhausted_pool(empty_pool, monkeypatch):
+    monkeypatch.setattr(utils, "_pool_created", settings.DUCKDB_POOL_SIZE)
+
+    with pytest.raises(HTTPException) as e:
+        with utils.checkout():
+            pass
+    assert e.value.status_code == 503
+
+
+def test_bytes_lru_cache_evicts_least_recently_used():
+    cache = utils.BytesLRUCache(max_bytes=40)
+    cache.set("a", b"a" * 10)
+    cache.set("b", b"b" * 10)
+    cache.set("c", b"c" * 10)
+    cache.set("d", b"d" * 10)
+    assert cache.get("a") == b"a" * 10
+
+    # total size would exceed 40 bytes, least recently used `b` is evicted
+    cache.set("e", b"e" * 10)
+    assert cache.get("b") is None
+    assert [cache.get(k) is not None for k in "acde"] == [True] * 4
+
+
+def test_bytes_lru_cache_rejects_large_values():
+    cache = utils.BytesLRUCache(max_bytes=40)
+    assert cache.fits(10)
+    assert not cache.fits(11)
+
+    cache.set("a", b"a" * 11)
+    assert cache.get("a") is None
+
+
+def test_ttl_cache_expires_values(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now)
+    calls = []
+
+    @utils.ttl_cache(maxsize=10, ttl=60)
+    def f(x):
+        calls.append(x)
+        return x
+
+    assert f(1) == 1
+    now = 59.0
+    assert f(1) == 1
+    assert calls == [1]
+
+    now = 60.0
+    assert f(1) == 1
+    assert calls == [1, 1]
+
+
+def test_ttl_cache_does_not_cache_exceptions():
+    calls = []
+
+    @utils.ttl_cache(maxsize=10, ttl=60)
+    def f(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise HTTPException(status_code=404)
+        return x
+
+    with pytest.raises(HTTPException):
+        f(1)
+    assert f(1) == 1
+    assert calls == [1, 1]
@@ -1,10 +1,13 @@
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 import io
 
 from fastapi.testclient import TestClient
 
 from app.main import app, settings
+from app.v1 import data
+from app.v1.metadata import _json_text
 
 client = TestClient(app)
 
@@ -30,6 +33,30 @@ def test_variableById_data_for_variable():
     }
 
 
+def test_variableById_data_not_modified():
+    response = client.get("/v1/variableById/data/42539")
+    assert response.status_code == 200
+
+    response = client.get(
+        "/v1/variableById/data/42539",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_variableById_data_not_modified_weak_etag():
+    response = client.get("/v1/variableById/data/42539")
+    assert response.status_code == 200
+
+    response = client.get(
+        "/v1/variableById/data/42539",
+        headers={"If-None-Match": f'"other", W/{response.headers["ETag"]}'},
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+
 def test_variableById_metadata_for_backported_variable():
     # this test requires connection to the database, this is only temporary and will change once we start getting
     # metadata from the catalog instead of the database
@@ -88,6 +115,18 @@ def test_variableById_metadata_for_backported_variable():
     }
 
 
+def test_json_text_of_nested_original_metadata():
+    # nested values of `originalMetadata` and `grapherConfig` are returned as compact
+    # JSON text with unescaped unicode, just like DuckDB's `->>` operator returns them
+    original_metadata = {"source": {"name": "Comin and Hobijn (2004)"}, "note": "é"}
+    assert (
+        _json_text(original_metadata)
+        == '{"source":{"name":"Comin and Hobijn (2004)"},"note":"é"}'
+    )
+    assert _json_text('{"a": 1}') == '{"a": 1}'
+    assert _json_text(None) is None
+
+
 TEST_RESPONSE_JSON = {
     "country": ["Afghanistan", "Afghanistan"],
     "population": [3280000.0, 4207000.0],
@@ -112,6 +151,12 @@ def test_dataset_data_for_etl_table_csv_format():
         params={"limit": 2, "columns": "year,country,population"},
     )
     assert response.status_code == 200
+    # pyarrow writes whole floats without decimals
+    assert response.text == (
+        '"year","country","population"\n'
+        '1820,"Afghanistan",3280000\n'
+        '1870,"Afghanistan",4207000\n'
+    )
     df = pd.read_csv(io.StringIO(response.text))
     assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
 
@@ -126,6 +171,119 @@ def test_dataset_data_for_etl_table_feather_format():
     assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
 
 
+def test_dataset_data_for_etl_table_feather_direct_format():
+    response = client.get(
+        "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.feather_direct",
+        params={"limit": 2, "columns": "year,country,population"},
+    )
+    assert response.status_code == 200
+    df = pd.read_feather(io.BytesIO(response.content))
+    assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
+
+
+def test_dataset_data_for_etl_table_feather_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "FEATHER_CACHE_DIR", tmp_path)
+    writes = []
+    write_feather = data._write_feather
+
+    def _write_feather(tb, dest):
+        writes.append(dest)
+        write_feather(tb, dest)
+
+    monkeypatch.setattr(data, "_write_feather", _write_feather)
+
+    url = "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.feather"
+    first = client.get(url)
+    second = client.get(url)
+    assert first.status_code == second.status_code == 200
+
+    # file is written only once and then served from disk
+    assert len(writes) == 1
+    assert len(list(tmp_path.glob("*.feather"))) == 1
+    assert list(tmp_path.glob("*.tmp")) == []
+    assert first.content == second.content
+
+    df = pd.read_feather(io.BytesIO(second.content))
+    df = df[["country", "population", "year"]].head(2)
+    assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
+
+    # custom columns or limit are not cached
+    client.get(url, params={"limit": 2})
+    client.get(url, params={"columns": "year,country"})
+    assert len(list(tmp_path.glob("*.feather"))) == 1
+
+
+def test_dataset_data_for_etl_table_feather_is_not_gzipped():
+    # feather is already compressed with zstd
+    response = client.get(
+        "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.feather_direct",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+def test_dataset_data_for_etl_table_arrow_format():
+    response = client.get(
+        "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.arrow",
+        params={"limit": 2, "columns": "year,country,population"},
+    )
+    assert response.status_code == 200
+    df = pa.ipc.open_stream(response.content).read_pandas()
+    assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
+
+
+def test_dataset_data_for_etl_table_arrow_accept_header():
+    response = client.get(
+        "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.json",
+        params={"limit": 2, "columns": "year,country,population"},
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    df = pa.ipc.open_stream(response.content).read_pandas()
+    assert df.to_dict(orient="list") == TEST_RESPONSE_JSON
+
+
+def test_dataset_data_for_etl_table_not_modified():
+    url = "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.json"
+    response = client.get(url, params={"limit": 2})
+    assert response.status_code == 200
+
+    response = client.get(
+        url,
+        params={"limit": 2},
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_dataset_data_for_etl_table_etag_depends_on_accept_header():
+    url = "/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp.json"
+    arrow = {"Accept": "application/vnd.apache.arrow.stream"}
+    etag_json = client.get(url, params={"limit": 2}).headers["ETag"]
+    etag_arrow = client.get(url, params={"limit": 2}, headers=arrow).headers["ETag"]
+    assert etag_json != etag_arrow
+
+    # JSON version must not be revalidated for Arrow clients
+    response = client.get(
+        url, params={"limit": 2}, headers={**arrow, "If-None-Match": etag_json}
+    )
+    assert response.status_code == 200
+
+    response = client.get(
+        url, params={"limit": 2}, headers={**arrow, "If-None-Match": etag_arrow}
+    )
+    assert response.status_code == 304
+    assert response.headers["Vary"] == "Accept"
+
+
+def test_dataset_data_for_etl_table_not_found():
+    response = client.get("/v1/dataset/data/garden/ggdc/2020-10-01/nope/nope.json")
+    assert response.status_code == 404
+
+
 def test_dataset_metadata_for_etl_table():
     response = client.get(
         "/v1/dataset/metadata/garden/ggdc/2020-10-01/ggdc_maddison/maddison_gdp",
@@ -254,7 +412,7 @@ def test_search():
             {
                 "variable_name": "population",
                 "variable_title": "Population",
-                "variable_description": "nan",
+                "variable_description": None,
                 "variable_unit": "people",
                 "table_name": "maddison_gdp",
                 "dataset_title": "Maddison Project Database (GGDC, 2020)",
@@ -277,3 +435,54 @@ def test_search():
             },
         ]
     }
+
+
+def test_search_channels():
+    response = client.get(
+        "/v1/search",
+        params={"term": "population", "channels": ["garden"]},
+    )
+    assert response.status_code == 200
+    assert (
+        response.json()
+        == client.get("/v1/search", params={"term": "population"}).json()
+    )
+    assert len(response.json()["results"]) == 2
+
+
+def test_search_channels_are_not_interpolated():
+    response = client.get(
+        "/v1/search",
+        params={"term": "population", "channels": ["gar'den"]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"results": []}
+
+
+def test_list_catalog():
+    js = client.get("/v1/dataset/data").json()
+    assert {"garden", "backport"} <= set(js["channels"])
+
+    js = client.get("/v1/dataset/data/garden").json()
+    assert "ggdc" in js["namespaces"]
+
+    js = client.get("/v1/dataset/data/garden/ggdc").json()
+    assert "2020-10-01" in js["versions"]
+
+    js = client.get("/v1/dataset/data/garden/ggdc/2020-10-01").json()
+    assert "ggdc_maddison" in js["datasets"]
+
+    js = client.get("/v1/dataset/data/garden/ggdc/2020-10-01/ggdc_maddison").json()
+    assert "maddison_gdp" in js["tables"]
+
+
+def test_list_catalog_unknown_path():
+    assert client.get("/v1/dataset/data/nope").json() == {"namespaces": []}
+    assert client.get("/v1/dataset/data/garden/nope").json() == {"versions": []}
+    assert client.get("/v1/dataset/data/garden/ggdc/nope").json() == {"datasets": []}
+    assert client.get("/v1/dataset/data/garden/ggdc/2020-10-01/nope").json() == {
+        "tables": []
+    }
+    assert client.get("/v1/dataset/data/nope/ggdc/2020-10-01/ggdc_maddison").json() == {
+        "tables": []
+    }